@@ -1,109 +1,216 @@
 """
-Flask API for receipt processing. Uses shared pipeline.process_receipt_image().
+FastAPI (ASGI) API for receipt processing. Uses shared pipeline.process_receipt_image().
 POST /api/process: image (file or path) + optional questions.
 - API_MODE=async (default): returns 202 + job_id; worker processes in background and POSTs to CALLBACK_URL.
-- API_MODE=sync: blocks and returns 200 with receipt JSON. One pipeline at a time (sync and async share a semaphore).
+- API_MODE=sync: awaits the pipeline and returns 200 with receipt JSON. PIPELINE_CONCURRENCY pipelines at a time (default 1; sync and async share the throttle).
+Run with: uvicorn api:app --host 0.0.0.0 --port 5050
 """
+import asyncio
 import io
-import json
 import logging
+import multiprocessing
 import os
-import queue
-import tempfile
-import threading
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
-import requests
+import httpx
+import orjson
 from dotenv import load_dotenv
 load_dotenv()
 
-from flask import Flask, request, jsonify
+from fastapi import FastAPI, Request, Response
 from PIL import Image
+from starlette.datastructures import UploadFile
 
+from llm_normalize import warmup_vision_model
 from pipeline import process_receipt_image
 
-app = Flask(__name__)
 logger = logging.getLogger(__name__)
 
-# Job queue and single worker (one process at a time)
-_job_queue = queue.Queue()
-_temp_dir = tempfile.mkdtemp(prefix="receipt_ocr_")
-_pipeline_semaphore = threading.Semaphore(1)  # shared by sync and async: only one pipeline run at a time
+# Bounded job queue drained by PIPELINE_CONCURRENCY worker tasks (default: one job at a time). Env: MAX_QUEUE (default 32); full queue → 429.
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", "32"))
+_job_queue = asyncio.Queue(maxsize=MAX_QUEUE)
+MAX_QUESTIONS = 32  # cap on the optional questions list per request
 CALLBACK_TIMEOUT_SEC = 30
 CALLBACK_RETRIES = 2
+# Shared keep-alive callback client (HTTP/2 when the callback server negotiates it); closed on shutdown
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=CALLBACK_TIMEOUT_SEC,
+    headers={"Content-Type": "application/json"},
+    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60),
+)
 
+# Pipeline throttle shared by sync and async: counter of active runs guarded by a condition.
+# Env: PIPELINE_CONCURRENCY (default 1). Read once at import: it also sizes _pipeline_executor and the number of
+# async worker tasks, so changing it requires a restart.
+PIPELINE_MAX_CONCURRENCY = max(1, int(os.environ.get("PIPELINE_CONCURRENCY", "1")))
+_pipeline_active = 0
+_pipeline_cv = asyncio.Condition()
 
-def _is_async_mode():
-    """True if API_MODE is async (default); False if sync."""
-    mode = os.environ.get("API_MODE", "async").strip().lower()
-    return mode in ("async", "1", "true", "yes")
 
-ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
+# Env: EXECUTOR=thread (default) | process. Process workers need picklable input: hand them the compressed bytes,
+# never an open stream.
+_PROCESS_EXECUTOR = os.environ.get("EXECUTOR", "thread").strip().lower() == "process"
+
+
+def _make_pipeline_executor():
+    """
+    Executor that decodes images and runs process_receipt_image (created in _lifespan). Env: EXECUTOR.
+    thread: the pipeline mostly waits on the Ollama HTTP call and Pillow releases the GIL while resizing/encoding,
+    so threads cost little memory and do not contend with the event loop.
+    process: isolates pipeline CPU work from the server's GIL, at the cost of one interpreter (tens of MB) per slot.
+    Workers are spawned, not forked: a fork would copy the server's threads and the Ollama client's pooled keep-alive
+    socket (opened by the warmup), and workers sharing one connection interleave their requests.
+    """
+    if _PROCESS_EXECUTOR:
+        return ProcessPoolExecutor(
+            max_workers=PIPELINE_MAX_CONCURRENCY, mp_context=multiprocessing.get_context("spawn")
+        )
+    return ThreadPoolExecutor(max_workers=PIPELINE_MAX_CONCURRENCY, thread_name_prefix="pipeline")
+
+
+# Created on startup, not at import: spawned process workers import this module and must not build their own pool.
+_pipeline_executor = None
+
+
+# True if API_MODE is async (default); False if sync. Read once at import (after load_dotenv).
+_ASYNC_MODE = os.environ.get("API_MODE", "async").strip().lower() in ("async", "1", "true", "yes")
+
+ALLOWED_EXTENSIONS = frozenset({"png", "jpg", "jpeg"})
 
 
 def _allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    """True if filename (or path) ends in an allowed image extension; single scan from the right."""
+    _, dot, ext = filename.rpartition(".")
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+
+async def _read_request_body(request):
+    """Return (form, data): multipart/urlencoded form or JSON body dict (the other is None/empty)."""
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            data = await request.json()
+        except Exception:
+            data = {}
+        return None, data if isinstance(data, dict) else {}
+    return await request.form(), {}
+
+
+def _check_image(fp):
+    """Return None if the stream opens as an image (header only, no full decode), else an error message. Rewinds fp."""
+    try:
+        with Image.open(fp):
+            pass
+    except Exception as e:
+        return f"Invalid image: {e!s}"
+    finally:
+        fp.seek(0)
+    return None
 
 
-def _load_image_from_request():
-    """Load PIL Image from request: uploaded file, form path, or JSON body."""
-    file = request.files.get("image") or request.files.get("file")
-    if file and getattr(file, "filename", None) and file.filename.strip():
+def _decode_image(fp):
+    """
+    Decode an image stream into an RGB PIL Image. Caller closes the result.
+    RGB sources (most JPEGs) are returned as-is after load(); convert() would copy the whole buffer.
+    """
+    src = Image.open(fp)
+    if src.mode == "RGB":
+        try:
+            src.load()
+        except Exception:
+            src.close()
+            raise
+        return src
+    with src:
+        return src.convert("RGB")
+
+
+class _InvalidImage(Exception):
+    """Raised by _decode_and_process when the image bytes cannot be decoded."""
+
+
+def _decode_and_process(source, questions):
+    """
+    Executor callable: decode source (bytes or binary stream) to RGB and run process_receipt_image.
+    Decoding here keeps the full Pillow decode off the event loop; raises _InvalidImage if decoding fails.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    try:
+        image = _decode_image(source)
+    except Exception as e:
+        raise _InvalidImage(str(e)) from e
+    try:
+        return process_receipt_image(image, questions)
+    finally:
+        image.close()
+
+
+def _load_image_from_request(form, data):
+    """
+    Open the request image: uploaded file, form path, or JSON body. Returns (stream, error).
+    The stream is a readable binary file (upload spool or opened path) at offset 0; caller must close it.
+    """
+    file = form and (form.get("image") or form.get("file"))
+    if isinstance(file, UploadFile) and file.filename and file.filename.strip():
         if not _allowed_file(file.filename):
             return None, "Invalid image type; use PNG or JPEG"
-        try:
-            image = Image.open(io.BytesIO(file.read())).convert("RGB")
-            return image, None
-        except Exception as e:
-            return None, f"Invalid image: {e!s}"
+        file.file.seek(0)
+        err = _check_image(file.file)
+        return (None, err) if err else (file.file, None)
 
-    path = (
-        request.form.get("image")
-        or request.form.get("file")
-        or request.form.get("image_path")
-    )
-    if not path and request.form:
+    path = None
+    if form:
         for key in ("image", "file", "image_path", "path"):
-            v = request.form.get(key)
-            if v and isinstance(v, str) and (v.strip().startswith("/") or ":\\" in v or (len(v) >= 2 and v[1] == ":")):
+            v = form.get(key)
+            if v and isinstance(v, str):
                 path = v
                 break
-        if not path:
-            for _, v in request.form.items():
-                if isinstance(v, str) and (":\\" in v or (v.startswith("/") and os.path.sep in v)):
-                    path = v
-                    break
 
-    if not path and request.is_json:
-        try:
-            data = request.get_json(silent=True) or {}
-            path = data.get("image_path") or data.get("image") or data.get("file")
-        except Exception:
-            pass
+    if not path and data:
+        path = data.get("image_path") or data.get("image") or data.get("file")
 
     if path and isinstance(path, str):
         path = path.strip().strip('"').replace("/", os.path.sep)
-        if path and os.path.isfile(path):
-            ext = path.rsplit(".", 1)[-1].lower() if "." in path else ""
-            if ext not in ALLOWED_EXTENSIONS:
-                return None, "Invalid image type; use PNG or JPEG"
-            try:
-                image = Image.open(path).convert("RGB")
-                return image, None
-            except Exception as e:
-                return None, f"Invalid image: {e!s}"
-        return None, f"File not found or not a file: {path!r}"
+        if not path:
+            return None, f"File not found or not a file: {path!r}"
+        if not _allowed_file(path):
+            return None, "Invalid image type; use PNG or JPEG"
+        # Single open (no isfile pre-check): one syscall and no window for the file to vanish in between
+        try:
+            fp = open(path, "rb")
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None, f"File not found or not a file: {path!r}"
+        except OSError as e:
+            return None, f"Invalid image: {e!s}"
+        err = _check_image(fp)
+        if err:
+            fp.close()
+            return None, err
+        return fp, None
     return None, "Missing image: use image=@path (file upload), image=path (form), or JSON {\"image_path\": \"C:\\\\path\"}"
 
 
-def _save_image_to_temp(image, job_id):
-    """Save PIL Image to temp file; return path. Caller/worker must delete when done."""
-    path = os.path.join(_temp_dir, f"{job_id}.png")
-    image.save(path)
-    return path
+def _parse_questions(form):
+    """
+    Parse optional JSON list of questions from the form; return list of str (empty if absent/invalid).
+    Non-list strings are rejected without parsing; at most MAX_QUESTIONS are kept.
+    """
+    raw = form.get("questions") if form else None
+    if not isinstance(raw, str) or not raw.lstrip().startswith("["):
+        return []
+    try:
+        q = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return []
+    if isinstance(q, list):
+        return [str(x) for x in q[:MAX_QUESTIONS]]
+    return []
 
 
-def _send_callback(job_id, payload):
+async def _send_callback(job_id, payload):
     """POST payload to CALLBACK_URL with retries. Log and return on failure."""
     callback_url = os.environ.get("CALLBACK_URL", "").strip()
     if not callback_url:
@@ -111,24 +218,40 @@ def _send_callback(job_id, payload):
         return
     for attempt in range(CALLBACK_RETRIES + 1):
         try:
-            r = requests.post(
-                callback_url,
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                timeout=CALLBACK_TIMEOUT_SEC,
-            )
+            r = await _http.post(callback_url, json=payload)
             r.raise_for_status()
             logger.info("Callback succeeded for job_id=%s", job_id)
             return
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.warning("Callback attempt %s failed for job_id=%s: %s", attempt + 1, job_id, e)
     logger.error("Callback failed after %s attempts for job_id=%s", CALLBACK_RETRIES + 1, job_id)
 
 
+async def _run_pipeline(source, questions):
+    """
+    Decode source and run process_receipt_image off the event loop (in _pipeline_executor).
+    Waits until fewer than PIPELINE_MAX_CONCURRENCY runs are active; shared by sync requests and the async worker.
+    """
+    global _pipeline_active
+    async with _pipeline_cv:
+        await _pipeline_cv.wait_for(lambda: _pipeline_active < PIPELINE_MAX_CONCURRENCY)
+        _pipeline_active += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_pipeline_executor, _decode_and_process, source, questions)
+    finally:
+        async with _pipeline_cv:
+            _pipeline_active -= 1
+            _pipeline_cv.notify(1)
+
+
+def _json_response(content, status_code=200):
+    """JSON response encoded with orjson (no jsonable_encoder pass, no deprecated ORJSONResponse)."""
+    return Response(orjson.dumps(content), status_code=status_code, media_type="application/json")
 
 
 def _build_receipt_response(result):
-    """Build JSON response dict from pipeline result (for sync mode)."""
+    """Build receipt JSON dict from pipeline result (sync response body and async callback payload)."""
     response = {
         "receipt": result["receipt"],
         "category": result["receipt"].get("category")
@@ -138,98 +261,93 @@ def _build_receipt_response(result):
     return response
 
 
-def _worker():
-    """Single worker: get job from queue, run pipeline, POST to callback, delete temp file."""
+async def _process_job(job):
+    """Load the job's image, run the pipeline, POST the result (or failure) to the callback."""
+    job_id = job["job_id"]
+    try:
+        result = await _run_pipeline(job["image_bytes"], job["questions"])
+    except _InvalidImage as e:
+        await _send_callback(job_id, {"job_id": job_id, "status": "failed", "error": f"Failed to load image: {e!s}"})
+        return
+    except Exception as e:
+        await _send_callback(job_id, {"job_id": job_id, "status": "failed", "error": str(e)})
+        return
+    await _send_callback(job_id, {"job_id": job_id, "status": "completed", **_build_receipt_response(result)})
+
+
+async def _worker():
+    """Worker task: get job from queue, run pipeline, POST to callback."""
     while True:
-        job = _job_queue.get()
-        if job is None:
-            break
-        job_id = job["job_id"]
-        image_path = job["image_path"]
-        questions = job["questions"]
+        job = await _job_queue.get()
         try:
-            try:
-                image = Image.open(image_path).convert("RGB")
-            except Exception as e:
-                _send_callback(job_id, {"job_id": job_id, "status": "failed", "error": f"Failed to load image: {e!s}"})
-                if os.path.isfile(image_path):
-                    try:
-                        os.remove(image_path)
-                    except OSError:
-                        pass
-                continue
-            try:
-                _pipeline_semaphore.acquire()
-                try:
-                    result = process_receipt_image(image, questions=questions)
-                finally:
-                    _pipeline_semaphore.release()
-            except Exception as e:
-                _send_callback(job_id, {"job_id": job_id, "status": "failed", "error": str(e)})
-                if os.path.isfile(image_path):
-                    try:
-                        os.remove(image_path)
-                    except OSError:
-                        pass
-                continue
-            payload = {
-                "job_id": job_id,
-                "status": "completed",
-                "receipt": result["receipt"],
-                "category": result["receipt"].get("category"),
-            }
-            if result.get("receipt_meta"):
-                payload["receipt_meta"] = result["receipt_meta"]
-            _send_callback(job_id, payload)
+            await _process_job(job)
+        except Exception:
+            logger.exception("Unhandled error processing job_id=%s", job.get("job_id"))
         finally:
-            if os.path.isfile(image_path):
-                try:
-                    os.remove(image_path)
-                except OSError as e:
-                    logger.warning("Could not delete temp file %s: %s", image_path, e)
-        _job_queue.task_done()
+            _job_queue.task_done()
 
 
-_worker_thread = threading.Thread(target=_worker, daemon=True)
-_worker_thread.start()
+@asynccontextmanager
+async def _lifespan(app):
+    """
+    Create the pipeline executor, start the vision model warmup (in the default executor, so health checks are served
+    meanwhile) and one background worker task per pipeline slot; stop them, close the callback client and the
+    pipeline executor on shutdown.
+    """
+    global _pipeline_executor
+    _pipeline_executor = _make_pipeline_executor()
+    asyncio.get_running_loop().run_in_executor(None, warmup_vision_model)
+    workers = [asyncio.create_task(_worker()) for _ in range(PIPELINE_MAX_CONCURRENCY)]
+    yield
+    for worker in workers:
+        worker.cancel()
+    await _http.aclose()
+    await asyncio.to_thread(_pipeline_executor.shutdown, wait=True, cancel_futures=True)
 
 
-@app.route("/health", methods=["GET"])
-def health():
-    return jsonify({"status": "ok"})
+app = FastAPI(title="Receipt OCR", lifespan=_lifespan)
 
 
-@app.route("/api/process", methods=["POST"])
-def process():
-    image, err = _load_image_from_request()
-    if err:
-        return jsonify({"error": err}), 400
+@app.get("/health")
+async def health():
+    return _json_response({"status": "ok"})
 
-    questions = []
-    if request.form.get("questions"):
-        try:
-            q = json.loads(request.form["questions"])
-            if isinstance(q, list) and len(q) > 0:
-                questions = [str(x) for x in q]
-        except (json.JSONDecodeError, TypeError):
-            pass
 
-    if _is_async_mode():
-        job_id = str(uuid.uuid4())
-        image_path = _save_image_to_temp(image, job_id)
-        _job_queue.put({"job_id": job_id, "image_path": image_path, "questions": questions})
-        return jsonify({"job_id": job_id}), 202
+@app.post("/api/process")
+async def process(request: Request):
+    form, data = await _read_request_body(request)
+    fp, err = _load_image_from_request(form, data)
+    if err:
+        return _json_response({"error": err}, status_code=400)
+
+    questions = _parse_questions(form)
 
-    # Sync mode: run pipeline in request thread (one at a time via semaphore)
-    _pipeline_semaphore.acquire()
     try:
-        result = process_receipt_image(image, questions=questions)
-        return jsonify(_build_receipt_response(result))
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        if _ASYNC_MODE:
+            if _job_queue.full():
+                return _json_response({"error": "Job queue is full; retry later"}, status_code=429)
+            # Read in a thread: a rolled-over upload spool or an image_path file is a blocking disk read
+            image_bytes = await asyncio.to_thread(fp.read)
+            job_id = str(uuid.uuid4())
+            try:
+                _job_queue.put_nowait({"job_id": job_id, "image_bytes": image_bytes, "questions": questions})
+            except asyncio.QueueFull:  # filled by other requests while this one was reading
+                return _json_response({"error": "Job queue is full; retry later"}, status_code=429)
+            return _json_response({"job_id": job_id}, status_code=202)
+
+        # Sync mode: decode + pipeline in the executor (threads read the stream directly; one at a time via the throttle)
+        try:
+            source = await asyncio.to_thread(fp.read) if _PROCESS_EXECUTOR else fp
+            result = await _run_pipeline(source, questions)
+        except _InvalidImage as e:
+            return _json_response({"error": f"Invalid image: {e!s}"}, status_code=400)
+        except Exception as e:
+            return _json_response({"error": str(e)}, status_code=500)
+        return _json_response(_build_receipt_response(result))
     finally:
-        _pipeline_semaphore.release()
+        fp.close()
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5050, debug=False)
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=5050)
@@ -1,30 +1,41 @@
 """
-Gradio UI for receipt processing. Uses shared pipeline.process_receipt_image().
+Gradio UI for receipt processing. Uses shared pipeline.process_receipt_images() (batched, async).
 """
-import json
+import threading
 
+import orjson
 from dotenv import load_dotenv
 load_dotenv()
 
 import gradio as gr
 
-from pipeline import process_receipt_image
+from llm_normalize import warmup_vision_model
+from pipeline import process_receipt_images
 
+MAX_BATCH_SIZE = 4  # concurrent uploads Gradio coalesces into one run_ui call
+MAX_QUEUE_SIZE = 32  # pending UI requests before Gradio rejects new ones
 
-def run_ui(image):
-    """Gradio handler: call shared pipeline and format outputs for UI."""
-    if image is None:
-        return "Please upload an image.", "", ""
 
-    result = process_receipt_image(image)
-
-    receipt_str = json.dumps(result["receipt"], indent=2, ensure_ascii=False)
+def _format_result(result):
+    """Format one pipeline result as the receipt textbox value."""
+    receipt_str = orjson.dumps(result["receipt"], option=orjson.OPT_INDENT_2).decode()
     if result.get("receipt_meta") and "_error" in result["receipt_meta"]:
         receipt_str += "\n\n⚠️ " + result["receipt_meta"]["_error"]
-
     return receipt_str
 
 
+async def run_ui(images):
+    """
+    Gradio batch handler: receives the images of up to MAX_BATCH_SIZE concurrent requests and runs them
+    through the shared pipeline together. Returns one list per output component.
+    """
+    results = iter(await process_receipt_images([image for image in images if image is not None]))
+    return [[
+        _format_result(next(results)) if image is not None else "Please upload an image."
+        for image in images
+    ]]
+
+
 with gr.Blocks(title="Receipt/Document Analysis") as demo:
     gr.Markdown("# 🧾 Receipt/Document Analysis")
     gr.Markdown(
@@ -47,7 +58,15 @@ with gr.Blocks(title="Receipt/Document Analysis") as demo:
         fn=run_ui,
         inputs=[image_input],
         outputs=[output_receipt],
+        batch=True,
+        max_batch_size=MAX_BATCH_SIZE,
+        concurrency_limit=1,  # one batch in flight; its receipts overlap on the Ollama server
     )
 
+# Gradio's queue holds web-side concurrency; handlers are async, so waiting on Ollama holds no worker thread
+demo.queue(max_size=MAX_QUEUE_SIZE)
+
 if __name__ == "__main__":
+    # Load the vision model in the background while the UI starts, so the first upload skips the model load
+    threading.Thread(target=warmup_vision_model, daemon=True).start()
     demo.launch(inbrowser=True)
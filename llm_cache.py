@@ -0,0 +1,115 @@
+"""
+Content-addressable on-disk cache for LLM extraction results. Key = SHA-256 of the inputs → one JSON file.
+Env: LLM_CACHE (default true; false/0/no disables), LLM_CACHE_DIR (default ~/.cache/airecieptocr),
+LLM_CACHE_MAX_ENTRIES (default 1000), LLM_CACHE_MAX_AGE_DAYS (default 30).
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+_ENABLED = os.environ.get("LLM_CACHE", "true").strip().lower() not in ("0", "false", "no", "off")
+_CACHE_DIR = os.path.expanduser(os.environ.get("LLM_CACHE_DIR", "").strip() or "~/.cache/airecieptocr")
+# Bounds: entries older than the max age are misses, and each write prunes expired entries and the oldest beyond the cap.
+_MAX_ENTRIES = max(1, int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "").strip() or "1000"))
+_MAX_AGE_SEC = float(os.environ.get("LLM_CACHE_MAX_AGE_DAYS", "").strip() or "30") * 86400
+
+
+def make_key(*parts: bytes) -> str:
+    """
+    Hash the given byte strings into a cache key (hex SHA-256).
+    Each part is prefixed with its 8-byte length so different splits of the same bytes never collide.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(len(part).to_bytes(8, "big"))
+        h.update(part)
+    return h.hexdigest()
+
+
+def _path(key: str) -> str:
+    return os.path.join(_CACHE_DIR, f"{key}.json")
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _prune() -> None:
+    """Delete expired entries, then the oldest ones beyond _MAX_ENTRIES."""
+    cutoff = time.time() - _MAX_AGE_SEC
+    entries = []
+    try:
+        with os.scandir(_CACHE_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if mtime < cutoff:
+                    _remove(entry.path)
+                else:
+                    entries.append((mtime, entry.path))
+    except OSError as e:
+        logger.warning("Could not prune cache dir %s: %s", _CACHE_DIR, e)
+        return
+    if len(entries) > _MAX_ENTRIES:
+        entries.sort()
+        for _, path in entries[:len(entries) - _MAX_ENTRIES]:
+            _remove(path)
+
+
+def get(key: str):
+    """Return the cached dict for key, or None (miss, disabled, expired, or unreadable entry)."""
+    if not _ENABLED:
+        return None
+    path = _path(key)
+    try:
+        with open(path, "rb") as f:
+            expired = os.fstat(f.fileno()).st_mtime < time.time() - _MAX_AGE_SEC
+            value = None if expired else orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.warning("Ignoring unreadable cache entry %s: %s", key, e)
+        return None
+    if expired:
+        _remove(path)
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def put(key: str, value: dict) -> None:
+    """Store value under key (atomic replace), then prune. Errors are logged, never raised."""
+    if not _ENABLED:
+        return
+    tmp = None
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(value))
+        os.replace(tmp, _path(key))
+        tmp = None
+    except OSError as e:
+        logger.warning("Could not write cache entry %s: %s", key, e)
+        return
+    finally:
+        if tmp:
+            _remove(tmp)
+    _prune()
+
+
+def delete(key: str) -> None:
+    """Evict key if present."""
+    _remove(_path(key))
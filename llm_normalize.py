@@ -1,45 +1,129 @@
 """
 Vision-based receipt extraction via Ollama API. Image → vision model → receipt JSON.
 """
-import json
+import asyncio
+import io
+import logging
 import os
 import re
-import tempfile
+import weakref
 
-RECEIPT_KEYS = [
-    "shop_name", "date", "total_amount", "tax_amount", "tax_percentage", "category"
-]
+import orjson
+from ollama import AsyncClient, Client, ResponseError
+from PIL import Image as PILImage
+
+import llm_cache
+
+logger = logging.getLogger(__name__)
+
+# Immutable so importers can iterate/hash it freely; _RECEIPT_KEY_SET for order-insensitive key checks.
+RECEIPT_KEYS = (
+    "shop_name", "date", "total_amount", "tax_amount", "tax_percentage", "category",
+)
+_RECEIPT_KEY_SET = frozenset(RECEIPT_KEYS)
 
 API_VISION_PROMPT = """Look at this receipt image. Extract the following fields and return ONLY a JSON object with exactly these keys (use null for any missing value). No markdown, no explanation, no other text—only the JSON.
 Keys: shop_name, date, total_amount, tax_amount, tax_percentage, category.
 For 'category', auto-detect from contents (e.g. Food, Travel, Shopping, Supplies, Utilities).
 Prefer numbers for amount fields when possible. The text can be GST, sales tax, or other taxes, so if all other taxes merge them, the text amount should be very critical."""
 
+# JSON schema passed as Ollama's `format`: decoding is constrained to exactly RECEIPT_KEYS, so output is always a
+# parseable object and the model cannot spend tokens on prose or extra keys.
+RECEIPT_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": ["string", "number", "null"]} for key in RECEIPT_KEYS},
+    "required": list(RECEIPT_KEYS),
+    "additionalProperties": False,
+}
+
+
+# Compiled once; only used when a model ignores `format` and wraps the JSON in a fence or prose.
+_CODE_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)```")
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.S)
+
 
 def _parse_ollama_response(text: str) -> dict:
-    """Parse LLM response into receipt dict; ensure all RECEIPT_KEYS exist."""
+    """
+    Parse LLM response into receipt dict; ensure all RECEIPT_KEYS exist.
+    With RECEIPT_SCHEMA the response is plain JSON; fences/prose are only stripped for servers/models that ignore `format`.
+    """
     text = text.strip()
     # Strip markdown code blocks if present
     if "```" in text:
-        match = re.search(r"```(?:json)?\s*([\s\S]*?)```", text)
+        match = _CODE_FENCE_RE.search(text)
         if match:
             text = match.group(1).strip()
+    # Cut any prose around the outermost {...}
+    if not (text.startswith("{") and text.endswith("}")):
+        match = _JSON_OBJECT_RE.search(text)
+        if match:
+            text = match.group(0)
     try:
-        data = json.loads(text)
-    except json.JSONDecodeError:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
         return {"_raw": text, "_error": "Invalid JSON from LLM"}
     if not isinstance(data, dict):
         return {"_raw": text, "_error": "LLM did not return a JSON object"}
     # Normalize to exact schema
-    receipt = {}
-    for key in RECEIPT_KEYS:
-        receipt[key] = data.get(key) if data.get(key) is not None else None
-    return receipt
+    get = data.get
+    return {key: get(key) for key in RECEIPT_KEYS}
+
+
+# Max dimension for vision uploads. Env: OLLAMA_VISION_MAX_PIXELS (default 1024): receipt layout and printed text
+# survive a 1024px long edge, while payload size and vision-encoder tokens drop ~4x vs 2048 (~9x for 3000px photos).
+_VISION_MAX_PIXELS = int(os.environ.get("OLLAMA_VISION_MAX_PIXELS", "1024"))
+_VISION_JPEG_QUALITY = int(os.environ.get("OLLAMA_VISION_JPEG_QUALITY", "85"))
+
+
+def _parse_keep_alive(value: str):
+    """OLLAMA_KEEP_ALIVE as Ollama expects it: seconds as int (-1 = forever) or a duration string like "30m"."""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
 
+# How long Ollama keeps the model loaded after a request. Env: OLLAMA_KEEP_ALIVE (default -1 = stay resident).
+_KEEP_ALIVE = _parse_keep_alive(os.environ.get("OLLAMA_KEEP_ALIVE", "-1").strip() or "-1")
+# Model options. Greedy decoding (temperature 0): extraction wants the single most likely answer, and identical
+# inputs give identical receipts (which is what the result caches assume).
+# Env: OLLAMA_NUM_PREDICT (max generated tokens, default 512: the receipt JSON needs ~100, so this
+# only cuts off runaway generations), OLLAMA_NUM_CTX (context window; unset = model default).
+_OLLAMA_OPTIONS = {"temperature": 0, "num_predict": int(os.environ.get("OLLAMA_NUM_PREDICT", "512"))}
+_NUM_CTX = os.environ.get("OLLAMA_NUM_CTX", "").strip()
+if _NUM_CTX:
+    _OLLAMA_OPTIONS["num_ctx"] = int(_NUM_CTX)
 
-# Max dimension for vision uploads (Ollama has request body limits). Env: OLLAMA_VISION_MAX_PIXELS (default 2048).
-_VISION_MAX_PIXELS = int(os.environ.get("OLLAMA_VISION_MAX_PIXELS", "2048"))
-_VISION_JPEG_QUALITY = int(os.environ.get("OLLAMA_VISION_JPEG_QUALITY", "88"))
+# Ollama server URL. Env: OLLAMA_HOST (default http://localhost:11434, the ollama client's own default).
+_OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "").strip() or None
+# Shared sync client: one HTTP connection pool to the Ollama server, reused across requests.
+_client = Client(host=_OLLAMA_HOST)
+# Shared async clients, one per event loop (an httpx pool is bound to the loop that created it).
+_async_clients = weakref.WeakKeyDictionary()
+
+
+async def _close_at_loop_shutdown(client):
+    """
+    Parked async generator that owns client. The loop finalizes it in shutdown_asyncgens() (asyncio.run does this
+    before closing the loop), so the connection pool is closed on its own loop instead of leaking.
+    """
+    try:
+        yield
+    finally:
+        _async_clients.pop(asyncio.get_running_loop(), None)
+        await client.close()
+
+
+async def _get_async_client() -> AsyncClient:
+    """AsyncClient for the running event loop; created once per loop and reused by every coroutine on it."""
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(loop)
+    if entry is None:
+        client = AsyncClient(host=_OLLAMA_HOST)
+        closer = _close_at_loop_shutdown(client)
+        entry = _async_clients[loop] = (client, closer)
+        await closer.__anext__()
+    return entry[0]
 
 
 def _get_vision_model() -> str:
@@ -47,58 +131,158 @@ def _get_vision_model() -> str:
     return os.environ.get("OLLAMA_VISION_MODEL", "").strip()
 
 
-def _prepare_image_for_vision(image):
+def _encode_image_for_vision(image) -> bytes:
     """
-    Resize image if needed and save as JPEG to stay under Ollama request body limits.
-    image: PIL Image (RGB). Returns path to temp .jpg; caller must delete when done.
+    Resize image if needed and encode as JPEG in memory to stay under Ollama request body limits.
+    image: PIL Image (RGB). Returns the JPEG bytes (passed to Ollama directly; no temp file).
     """
-    from PIL import Image as PILImage
     w, h = image.size
     max_p = _VISION_MAX_PIXELS
     if w > max_p or h > max_p:
         ratio = min(max_p / w, max_p / h)
         nw, nh = int(w * ratio), int(h * ratio)
-        image = image.resize((nw, nh), getattr(PILImage, "Resampling", PILImage).LANCZOS)
-    fd, path = tempfile.mkstemp(suffix=".jpg")
-    os.close(fd)
-    image.save(path, "JPEG", quality=_VISION_JPEG_QUALITY, optimize=True)
-    return path
+        # reducing_gap: cheap integer box-reduce first, then LANCZOS over the last ≤3x; same quality, much faster for phone photos
+        image = image.resize((nw, nh), getattr(PILImage, "Resampling", PILImage).LANCZOS, reducing_gap=3.0)
+    buf = io.BytesIO()
+    # Pillow only writes EXIF/ICC/XMP when passed explicitly, but copies the source JPEG's COM comment; drop it
+    image.save(buf, "JPEG", quality=_VISION_JPEG_QUALITY, optimize=True, comment=b"")
+    return buf.getvalue()
+
+
+# Keep the system message and prompt byte-identical across calls: Ollama reuses the KV cache for a matching prefix.
+_VISION_SYSTEM_MESSAGE = {"role": "system", "content": "You extract receipt data. You must respond with only valid JSON, nothing else."}
+_MISSING_MODEL_ERROR = {"_error": "OLLAMA_VISION_MODEL is not set. Set it in .env (e.g. qwen3-vl:8b, llava)."}
+
+
+def _vision_messages(jpeg: bytes) -> list:
+    """Chat messages for one receipt image (the prepared JPEG bytes)."""
+    return [
+        _VISION_SYSTEM_MESSAGE,
+        {"role": "user", "content": API_VISION_PROMPT, "images": [jpeg]},
+    ]
+
+
+def _vision_error(model: str, e) -> dict:
+    """Map an Ollama ResponseError to a receipt _error dict."""
+    msg = str(e).strip()
+    if "404" in msg or "not found" in msg.lower():
+        return {"_error": f"Ollama vision model {model!r} not found. Set OLLAMA_VISION_MODEL in .env (e.g. llava, qwen3-vl:8b)."}
+    return {"_error": f"Ollama error: {msg}"}
+
+
+def _receipt_from_response(response) -> dict:
+    """Parse an Ollama chat response into a receipt dict (RECEIPT_KEYS or _error/_raw)."""
+    text = response.message.content if response and response.message else ""
+    if not text:
+        return {"_error": "Empty response from Ollama"}
+    return _parse_ollama_response(text)
+
+
+# Decoding settings that change the output (schema, num_ctx, num_predict, temperature); part of every cache key.
+_CACHE_KEY_SETTINGS = orjson.dumps({"format": RECEIPT_SCHEMA, "options": _OLLAMA_OPTIONS}, option=orjson.OPT_SORT_KEYS)
+
+
+def _cache_key(model: str, jpeg: bytes) -> str:
+    """Cache key for one vision request: model, prompts, decoding settings and the exact JPEG bytes sent to Ollama."""
+    return llm_cache.make_key(
+        b"ollama-vision",
+        model.encode(),
+        _VISION_SYSTEM_MESSAGE["content"].encode(),
+        API_VISION_PROMPT.encode(),
+        _CACHE_KEY_SETTINGS,
+        jpeg,
+    )
+
+
+def _cached_receipt(key: str):
+    """Cached receipt for key, or None. Entries whose keys no longer match RECEIPT_KEYS are evicted."""
+    cached = llm_cache.get(key)
+    if cached is None:
+        return None
+    if cached.keys() != _RECEIPT_KEY_SET:
+        llm_cache.delete(key)
+        return None
+    return cached
+
+
+def _store_receipt(key: str, receipt: dict) -> None:
+    """Cache a successful extraction (never _error/_raw results)."""
+    if "_error" not in receipt and "_raw" not in receipt:
+        llm_cache.put(key, receipt)
+
+
+def _prepare_vision_request(image, model: str):
+    """Encode the JPEG and look it up in the cache. Returns (jpeg bytes, key, cached receipt or None)."""
+    jpeg = _encode_image_for_vision(image)
+    key = _cache_key(model, jpeg)
+    return jpeg, key, _cached_receipt(key)
 
 
 def _extract_via_ollama_vision(image) -> dict:
     """Send receipt image to Ollama vision model; return receipt dict (RECEIPT_KEYS or _error/_raw)."""
-    from ollama import chat, ResponseError
+    model = _get_vision_model()
+    if not model:
+        return dict(_MISSING_MODEL_ERROR)
+    jpeg, key, cached = _prepare_vision_request(image, model)
+    if cached is not None:
+        return cached
+    try:
+        response = _client.chat(
+            model=model,
+            messages=_vision_messages(jpeg),
+            format=RECEIPT_SCHEMA,
+            options=_OLLAMA_OPTIONS,
+            keep_alive=_KEEP_ALIVE,
+        )
+    except ResponseError as e:
+        return _vision_error(model, e)
+    receipt = _receipt_from_response(response)
+    _store_receipt(key, receipt)
+    return receipt
+
 
+async def _extract_via_ollama_vision_async(image) -> dict:
+    """
+    Async variant of _extract_via_ollama_vision using ollama.AsyncClient, so several receipts can wait on
+    the Ollama server concurrently (server-side parallelism: OLLAMA_NUM_PARALLEL). Image prep and cache I/O run in a thread.
+    """
     model = _get_vision_model()
     if not model:
-        return {"_error": "OLLAMA_VISION_MODEL is not set. Set it in .env (e.g. qwen3-vl:8b, llava)."}
-    path = None
+        return dict(_MISSING_MODEL_ERROR)
+    jpeg, key, cached = await asyncio.to_thread(_prepare_vision_request, image, model)
+    if cached is not None:
+        return cached
     try:
-        path = _prepare_image_for_vision(image)
-        try:
-            response = chat(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You extract receipt data. You must respond with only valid JSON, nothing else."},
-                    {"role": "user", "content": API_VISION_PROMPT, "images": [path]},
-                ],
-                format="json",
-            )
-        except ResponseError as e:
-            msg = str(e).strip()
-            if "404" in msg or "not found" in msg.lower():
-                return {"_error": f"Ollama vision model {model!r} not found. Set OLLAMA_VISION_MODEL in .env (e.g. llava, qwen3-vl:8b)."}
-            return {"_error": f"Ollama error: {msg}"}
-        text = response.message.content if response and response.message else ""
-        if not text:
-            return {"_error": "Empty response from Ollama"}
-        return _parse_ollama_response(text)
-    finally:
-        if path and os.path.isfile(path):
-            try:
-                os.remove(path)
-            except OSError:
-                pass
+        response = await (await _get_async_client()).chat(
+            model=model,
+            messages=_vision_messages(jpeg),
+            format=RECEIPT_SCHEMA,
+            options=_OLLAMA_OPTIONS,
+            keep_alive=_KEEP_ALIVE,
+        )
+    except ResponseError as e:
+        return _vision_error(model, e)
+    receipt = _receipt_from_response(response)
+    await asyncio.to_thread(_store_receipt, key, receipt)
+    return receipt
+
+
+def warmup_vision_model() -> bool:
+    """
+    Ask Ollama to load OLLAMA_VISION_MODEL into memory (empty chat = load only, no generation),
+    so the first receipt does not pay the model load. Returns True if the model is loaded; failures are only logged.
+    """
+    model = _get_vision_model()
+    if not model:
+        return False
+    try:
+        # Same options as real requests: a different num_ctx would make Ollama reload the model on the first receipt
+        _client.chat(model=model, messages=[], options=_OLLAMA_OPTIONS, keep_alive=_KEEP_ALIVE)
+    except Exception as e:
+        logger.warning("Ollama warmup for %r failed: %s", model, e)
+        return False
+    logger.info("Ollama vision model %r loaded", model)
+    return True
 
 
 def extract_receipt_from_image(image) -> dict:
@@ -107,3 +291,11 @@ def extract_receipt_from_image(image) -> dict:
     May include _error or _raw on failure. image: PIL Image (RGB).
     """
     return _extract_via_ollama_vision(image)
+
+
+async def extract_receipt_from_image_async(image) -> dict:
+    """
+    Async version of extract_receipt_from_image (ollama.AsyncClient); same return shape.
+    Use from async code (Gradio handlers, batch endpoints) so concurrent receipts overlap their Ollama round-trips.
+    """
+    return await _extract_via_ollama_vision_async(image)
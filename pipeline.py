@@ -1,21 +1,24 @@
 """
 Shared receipt pipeline: image → vision model (Ollama API) → receipt JSON.
-Used by both api.py (Flask) and app.py (Gradio). Single source of truth.
+Used by both api.py (FastAPI) and app.py (Gradio). Single source of truth.
 """
+import asyncio
 import logging
 import os
 
-from llm_normalize import extract_receipt_from_image, RECEIPT_KEYS
+from llm_normalize import extract_receipt_from_image, extract_receipt_from_image_async, RECEIPT_KEYS
 
-logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
+
+# Max receipts process_receipt_images sends to Ollama at once. Env: OLLAMA_NUM_PARALLEL (default 4);
+# set it to the server's value — requests beyond that only queue on the server.
+_MAX_PARALLEL = max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", "4")))
 
 
 def ensure_receipt_schema(receipt: dict) -> dict:
     """Ensure receipt has exactly RECEIPT_KEYS; strip _error/_raw for clean output."""
-    out = {}
-    for key in RECEIPT_KEYS:
-        out[key] = receipt.get(key) if key in receipt else None
-    return out
+    get = receipt.get
+    return {key: get(key) for key in RECEIPT_KEYS}
 
 
 def process_receipt_image(image, questions=None):
@@ -31,7 +34,38 @@ def process_receipt_image(image, questions=None):
             receipt: normalized dict (RECEIPT_KEYS only).
             receipt_meta: None or dict with _error/_raw if extraction failed.
     """
-    receipt = extract_receipt_from_image(image)
+    return _build_result(extract_receipt_from_image(image))
+
+
+async def process_receipt_image_async(image, questions=None):
+    """
+    Async version of process_receipt_image (Ollama AsyncClient); same args and return value.
+    Lets async callers (e.g. the Gradio UI) wait on the vision model without holding a thread.
+    """
+    return _build_result(await extract_receipt_from_image_async(image))
+
+
+async def process_receipt_images(images, questions=None) -> list:
+    """
+    Run process_receipt_image_async on several images concurrently (e.g. a Gradio batch),
+    at most OLLAMA_NUM_PARALLEL at a time. Returns one result dict per image, in input order.
+    A failing image (connection error, timeout, ...) yields a result with receipt_meta._error; the others are unaffected.
+    """
+    sem = asyncio.Semaphore(_MAX_PARALLEL)
+
+    async def _bounded(image):
+        async with sem:
+            try:
+                return await process_receipt_image_async(image, questions)
+            except Exception as e:
+                logger.exception("Receipt extraction failed for one image in batch")
+                return _build_result({"_error": str(e)})
+
+    return list(await asyncio.gather(*(_bounded(image) for image in images)))
+
+
+def _build_result(receipt: dict) -> dict:
+    """Split raw extraction output into the clean receipt and optional receipt_meta (_error/_raw)."""
     receipt_clean = ensure_receipt_schema(receipt)
     has_error = "_error" in receipt or "_raw" in receipt
     receipt_meta = {k: v for k, v in receipt.items() if k in ("_error", "_raw")} if has_error else None
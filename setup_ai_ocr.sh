@@ -70,8 +70,8 @@ create_venv_and_install() {
   if [ -f "$REQUIREMENTS_FILE" ]; then
     "$VENV_DIR/bin/pip" install -r "$REQUIREMENTS_FILE"
   else
-    echo "No requirements.txt found; installing gunicorn as a fallback"
-    "$VENV_DIR/bin/pip" install gunicorn
+    echo "No requirements.txt found; installing fastapi and uvicorn as a fallback"
+    "$VENV_DIR/bin/pip" install fastapi "uvicorn[standard]" python-multipart
   fi
 }
 
@@ -85,7 +85,7 @@ After=network.target
 [Service]
 User=$SERVICE_USER
 WorkingDirectory=$PROJECT_DIR
-ExecStart=$VENV_DIR/bin/python -m gunicorn -w 1 -b 0.0.0.0:5050 api:app
+ExecStart=$VENV_DIR/bin/python -m uvicorn api:app --host 0.0.0.0 --port 5050 --workers 1 --loop uvloop --http httptools
 Restart=always
 Environment="PATH=$VENV_DIR/bin"
 
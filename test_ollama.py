@@ -3,15 +3,27 @@ Test vision-based receipt extraction (same code path as the API).
 Run with: python test_ollama.py
 Requires OLLAMA_VISION_MODEL in .env and an image path as first argument, or a small test image.
 """
-import json
 import os
 import sys
 
+try:
+    import orjson
+except ImportError:  # orjson is in requirements.txt; stdlib json keeps the script usable without it
+    orjson = None
+    import json
+
 from dotenv import load_dotenv
 load_dotenv()
 
 from llm_normalize import extract_receipt_from_image
 
+
+def _dumps(result):
+    """Pretty-print result as indented JSON (orjson if available, else stdlib json)."""
+    if orjson is not None:
+        return orjson.dumps(result, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(result, indent=2, ensure_ascii=False)
+
 def main():
     model = os.environ.get("OLLAMA_VISION_MODEL", "").strip()
     if not model:
@@ -31,7 +43,7 @@ def main():
     result = extract_receipt_from_image(image)
     print()
     print("Result:")
-    print(json.dumps(result, indent=2, ensure_ascii=False))
+    print(_dumps(result))
     if "_error" in result:
         print("\n--> Vision extraction failed (check model name and Ollama/API)")
         sys.exit(1)